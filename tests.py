@@ -1,12 +1,27 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
+import tempfile
+import unittest
 import uuid
 
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
+
+import tornado.concurrent
+import tornado.gen
 from tornado.testing import AsyncTestCase
 from tornado.testing import gen_test
 
-from tornmc.client import Client, MemcachedKeyError
+from tornmc.client import Client, MemcachedKeyError, MemcachedServerError
+from tornmc.compress import CompressionPolicy
+from tornmc.replay import replay
+from tornmc.shm import SharedCache
+from tornmc.stats import StatsCollector, slab_classes
+from tornmc.trace import TraceRecorder, read_trace
 
 
 class ClientTestCase(AsyncTestCase):
@@ -229,7 +244,409 @@ class ClientTestCase(AsyncTestCase):
         for p in client.pools.values():
             self.assertEquals(p.active, 0)
 
+    @gen_test
+    def test_shared_cache(self):
+        cache = SharedCache(slots=64, max_value_size=64, ttl=5)
+        client = Client(['127.0.0.1:11211'], shared_cache=cache)
+        key = uuid.uuid4().hex
+        yield client.set(key, {'foo': 1}, 5)
+        res = yield client.get(key)
+        self.assertEqual(res, {'foo': 1})
+        self.assertIsNotNone(cache.get(key))
+        res = yield client.get(key)
+        self.assertEqual(res, {'foo': 1})
+        self.assertEqual(cache.hits, 2)
+        yield client.set(key, 'bar', 5)
+        self.assertIsNone(cache.get(key))
+        res = yield client.get_multi([key])
+        self.assertEqual(res, {key: 'bar'})
+        res = yield client.get_multi([key])
+        self.assertEqual(res, {key: 'bar'})
+        yield client.delete(key)
+        res = yield client.get(key)
+        self.assertEqual(res, None)
+        self.assertFalse(cache.set(key, 0, 'x' * 65))
+        # a fill that fetched before an invalidation is refused
+        token = cache.token(key)
+        cache.delete(key)
+        self.assertFalse(cache.set(key, 0, 'stale', token=token))
+        self.assertIsNone(cache.get(key))
+        # delete never waits for a writer holding the slot lock
+        lock = cache.locks[cache._slot(key)[0] % len(cache.locks)]
+        with lock:
+            cache.delete(key)
+            self.assertFalse(cache.set(key, 0, 'value'))
+        self.assertTrue(cache.set(key, 0, 'value'))
+        self.assertEqual(cache.get(key), (0, 'value'))
+        cache.delete(key)
+        self.assertIsNone(cache.get(key))
+
+    @unittest.skipIf(futures is None, 'concurrent.futures not installed')
+    @gen_test
+    def test_compress_executor(self):
+        executor = futures.ThreadPoolExecutor(2)
+        client = Client(['127.0.0.1:11211'], compress_executor=executor,
+                        async_compress_threshold=1024)
+        key = uuid.uuid4().hex
+        val = 'x' * 100000
+        yield client.set(key, val, 5, min_compress_len=1)
+        res = yield client.get(key)
+        self.assertEqual(res, val)
+        res = yield client.get_multi([key])
+        self.assertEqual(res, {key: val})
+        # compresses to well under the threshold but is inflated off the
+        # IOLoop all the same
+        submitted = []
+        submit = executor.submit
+        executor.submit = lambda *args: submitted.append(args[0]) or \
+            submit(*args)
+        yield client.set(key, val * 50, 5, min_compress_len=1)
+        res = yield client.get(key)
+        self.assertEqual(res, val * 50)
+        self.assertEqual(len(submitted), 2)
+        executor.shutdown()
+
+    @gen_test
+    def test_compress_policy(self):
+        policy = CompressionPolicy(sample_size=2, resample_interval=3)
+        client = Client(['127.0.0.1:11211'], compress_policy=policy)
+        for i in range(2):
+            yield client.set('rand_%d' % i, os.urandom(512), 5,
+                             min_compress_len=1)
+            yield client.set('text_%d' % i, 'a' * 512, 5,
+                             min_compress_len=1)
+        self.assertGreater(policy.ratio('rand'), 0.9)
+        self.assertLess(policy.ratio('text'), 0.9)
+        self.assertFalse(policy.should_compress('rand_2'))
+        self.assertTrue(policy.should_compress('text_2'))
+        self.assertFalse(policy.should_compress('rand_3'))
+        # resampled after resample_interval skipped values
+        self.assertTrue(policy.should_compress('rand_4'))
+
+        # keys without a prefix share a bucket, old prefixes are evicted
+        policy = CompressionPolicy(sample_size=1, max_prefixes=2)
+        for _ in range(4):
+            policy.record(uuid.uuid4().hex, 100, 10)
+        policy.record('img:1', 100, 100)
+        policy.record('jpg:1', 100, 100)
+        self.assertEqual(list(policy.prefixes), ['img', 'jpg'])
+        self.assertFalse(policy.should_compress('img:2'))
+
+    @gen_test
+    def test_set_nowait(self):
+        client = Client(['127.0.0.1:11211'], write_buffer_size=2)
+        key = uuid.uuid4().hex
+        self.assertTrue(client.set_nowait(key, 'foo', 5))
+        self.assertTrue(client.set_nowait(key, 'bar', 5))
+        key2 = uuid.uuid4().hex
+        self.assertTrue(client.set_nowait(key2, {'foo': 1}, 5))
+        yield client.flush_writes()
+        res = yield client.get_multi([key, key2])
+        self.assertEqual(res, {key: 'bar', key2: {'foo': 1}})
+        buf = client.write_buffers[client.get_host(key)]
+        self.assertEqual(buf.coalesced, 1)
+        self.assertEqual(buf.flushed, 2)
+        self.assertEqual(buf.dropped, 0)
+        for i in range(3):
+            client.set_nowait('%s_%d' % (key, i), i, 5)
+        self.assertEqual(buf.dropped, 1)
+        yield client.flush_writes()
+        res = yield client.get('%s_0' % key)
+        self.assertEqual(res, None)
+        res = yield client.get('%s_2' % key)
+        self.assertEqual(res, 2)
+
+    @gen_test
+    def test_set_nowait_ordering(self):
+        client = Client(['127.0.0.1:11211'])
+        key = uuid.uuid4().hex
+        client.set_nowait(key, 'old', 5)
+        yield client.delete(key)
+        yield client.flush_writes()
+        res = yield client.get(key)
+        self.assertEqual(res, None)
+
+        client.set_nowait(key, 'buffered', 5)
+        yield client.set(key, 'sync', 5)
+        yield client.flush_writes()
+        res = yield client.get(key)
+        self.assertEqual(res, 'sync')
+
+        # a batch already on the wire lands before the synchronous write
+        client.set_nowait(key, 'buffered', 5)
+        buf = client.write_buffers[client.get_host(key)]
+        flush = buf.flush()
+        while buf.sent is None:
+            yield tornado.gen.moment
+        yield client.set(key, 'sync', 5)
+        yield flush
+        res = yield client.get(key)
+        self.assertEqual(res, 'sync')
+
+    @gen_test
+    def test_set_nowait_serialize(self):
+        client = Client(['127.0.0.1:11211'], write_buffer_bytes=64)
+        key = uuid.uuid4().hex
+        value = {'a': 1}
+        self.assertRaises(TypeError, client.set_nowait,
+                          key + '_bad', lambda: 0, 5)
+        client.set_nowait(key, value, 5)
+        value['a'] = 2
+        yield client.flush_writes()
+        res = yield client.get(key)
+        self.assertEqual(res, {'a': 1})
+
+        # bounded by serialized bytes, not only by keys
+        buf = client.write_buffers[client.get_host(key)]
+        self.assertFalse(client.set_nowait(key, 'x' * 65, 5))
+        self.assertTrue(client.set_nowait(key, 'x' * 40, 5))
+        self.assertTrue(client.set_nowait(key + '_2', 'x' * 40, 5))
+        self.assertEqual(list(buf.pending), [key + '_2'])
+        self.assertEqual(buf.pending_bytes, 40)
+        self.assertEqual(buf.dropped, 2)
+        yield client.flush_writes()
+        self.assertEqual(buf.pending_bytes, 0)
+
+    @gen_test
+    def test_namespace(self):
+        client = Client(['127.0.0.1:11211'])
+        ns = client.namespace(uuid.uuid4().hex)
+        gen = yield ns.generation()
+        yield ns.set('foo', 'foo', 5)
+        yield ns.set_multi({'bar': 'bar', 'baz': 1}, 5)
+        res = yield ns.get('foo')
+        self.assertEqual(res, 'foo')
+        res = yield ns.get_multi(['foo', 'bar', 'baz'])
+        self.assertEqual(res, {'foo': 'foo', 'bar': 'bar', 'baz': 1})
+        new_gen = yield ns.invalidate()
+        self.assertEqual(new_gen, gen + 1)
+        res = yield ns.get('foo')
+        self.assertEqual(res, None)
+        res = yield ns.get_multi(['foo', 'bar', 'baz'])
+        self.assertEqual(res, {})
+        other = Client(['127.0.0.1:11211']).namespace(ns.name)
+        res = yield other.generation()
+        self.assertEqual(res, new_gen)
+
+        # an evicted counter is reseeded above the last generation seen
+        yield client.set(ns.generation_key, new_gen + 1000)
+        yield ns.invalidate()
+        yield client.delete(ns.generation_key)
+        res = yield ns.invalidate()
+        self.assertEqual(res, new_gen + 1002)
+
+    @gen_test
+    def test_trace_replay(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            recorder = TraceRecorder(path)
+            client = Client(['127.0.0.1:11211'], recorder=recorder)
+            key = uuid.uuid4().hex
+            yield client.set(key, 'value', 5)
+            yield client.get(key)
+            yield client.get_multi([key, 'missing'])
+            yield client.delete(key)
+            yield client.add(key + '_n', 1, 5)
+            yield client.incr(key + '_n')
+            # stamped with the issue time, not the completion time
+            recorder.record('get', key, 0, 0.5, '127.0.0.1:11211', 100.0)
+            recorder.close()
+            # an unclean shutdown in the middle of a host record
+            with open(path, 'ab') as f:
+                f.write(b'H\x01')
+            records = list(read_trace(path))
+            self.assertEqual([r[1] for r in records],
+                             ['set', 'get', 'get', 'get', 'delete', 'add',
+                              'incr', 'get'])
+            self.assertEqual([r[3] for r in records],
+                             [5, 5, 5, 0, 0, 1, 0, 0])
+            self.assertEqual(records[0][5], '127.0.0.1:11211')
+            self.assertEqual(records[-1][0], 100.0)
+            # a broken recorder is detached instead of failing requests
+            res = yield client.get(key)
+            self.assertEqual(res, None)
+            self.assertIsNone(client.recorder)
+            # replayed values stay numeric, so the incr succeeds
+            report = yield replay(path, Client(['127.0.0.1:11211']),
+                                  speed=0, concurrency=1)
+            self.assertEqual(report['ops'], 8)
+            self.assertEqual(report['errors'], {})
+            self.assertEqual(report['host_ops'], {'127.0.0.1:11211': 8})
+            self.assertEqual(report['skew'], 1.0)
+        finally:
+            os.remove(path)
+
+    @gen_test
+    def test_update_hosts(self):
+        client = Client(['127.0.0.1:11211'])
+        old_pool = client.pools['127.0.0.1:11211']
+        key = uuid.uuid4().hex
+        yield client.set(key, 'foo', 5)
+        client.update_hosts(['localhost:11211'], migration_window=60)
+        self.assertEqual(client.hosts, ['localhost:11211'])
+        self.assertIs(client.draining['127.0.0.1:11211'], old_pool)
+        self.assertEqual(client.old_hosts, ['127.0.0.1:11211'])
+        res = yield client.get(key)
+        self.assertEqual(res, 'foo')
+        new_pool = client.pools['localhost:11211']
+        client.update_hosts(['127.0.0.1:11211'], migration_window=0)
+        self.assertIs(client.pools['127.0.0.1:11211'], old_pool)
+        self.assertEqual(client.draining, {})
+        self.assertIsNone(client.old_hosts)
+        self.assertTrue(new_pool.closed)
+        res = yield client.get(key)
+        self.assertEqual(res, 'foo')
+        with self.assertRaises(ValueError):
+            client.update_hosts(['localhost:11211'], copy_forward=True,
+                                copy_expire=0)
+        with self.assertRaises(ValueError):
+            client.update_hosts([])
+        self.assertEqual(client.hosts, ['127.0.0.1:11211'])
+
+    @gen_test
+    def test_update_hosts_migration(self):
+        # both names reach the same server, so reads through the new
+        # host are made to miss and every value lives on the old one
+        new_host = 'localhost:11211'
+        client = Client(['127.0.0.1:11211'], io_loop=self.io_loop)
+        keys = [uuid.uuid4().hex for _ in range(3)]
+        yield client.set_multi(dict((k, k) for k in keys), 5)
+        client.set_nowait(keys[0], 'buffered', 5)
+        client.update_hosts([new_host], migration_window=60,
+                            copy_forward=True)
+        self.assertEqual(client.copy_expire, 60)
+        self.assertEqual(list(client.write_buffers[new_host].pending),
+                         [keys[0]])
+        self.assertFalse(client.write_buffers['127.0.0.1:11211'].pending)
+
+        get_raw, get_multi_raw = client._get_raw, client._get_multi_raw
+        old_hosts = []
+        copied = []
+
+        def stub_get_raw(cmd, key, host=None):
+            old_hosts.append(host)
+            if host is None:
+                return tornado.gen.maybe_future(None)
+            return get_raw(cmd, key, host)
+
+        def stub_get_multi_raw(host, key_list):
+            old_hosts.append(host)
+            if host == new_host:
+                return tornado.gen.maybe_future([])
+            return get_multi_raw(host, key_list)
+
+        def stub_copy_forward(key, flags, value):
+            copied.append((key, client.copy_expire))
+            return tornado.gen.maybe_future(None)
+
+        client._get_raw = stub_get_raw
+        client._get_multi_raw = stub_get_multi_raw
+        client._copy_forward = stub_copy_forward
+        res = yield client.get(keys[1])
+        self.assertEqual(res, keys[1])
+        self.assertEqual(old_hosts, [None, '127.0.0.1:11211'])
+        res = yield client.get_multi(keys[1:])
+        self.assertEqual(res, dict((k, k) for k in keys[1:]))
+        self.assertEqual(old_hosts[2:], [new_host, '127.0.0.1:11211'])
+        yield tornado.gen.moment
+        self.assertEqual(sorted(copied), sorted(
+            [(keys[1], 60)] + [(k, 60) for k in keys[1:]]))
+
+        # a delete also reaches the old host, so no fallback revives it
+        delete_migrated = client._delete_migrated
+        deleted = []
+
+        def stub_delete_migrated(key, old_host):
+            deleted.append((key, old_host))
+            return delete_migrated(key, old_host)
+
+        client._delete_migrated = stub_delete_migrated
+        client._get_raw = get_raw
+        res = yield client.delete(keys[2])
+        self.assertTrue(res)
+        self.assertEqual(deleted, [(keys[2], '127.0.0.1:11211')])
+        client._get_raw = stub_get_raw
+        res = yield client.get(keys[2])
+        self.assertEqual(res, None)
+
+        # a delete that did not reach the old host is not reported done
+        client._delete_migrated = \
+            lambda key, old_host: tornado.gen.maybe_future(False)
+        res = yield client.delete(keys[0])
+        self.assertFalse(res)
+
+    @gen_test
+    def test_stats(self):
+        client = Client(['127.0.0.1:11211'])
+        key = uuid.uuid4().hex
+        yield client.set(key, 'value', 5)
+        yield client.get(key)
+        res = yield client.stats()
+        self.assertGreater(res['127.0.0.1:11211']['get_hits'], 0)
+        self.assertIsInstance(res['127.0.0.1:11211']['version'], str)
+        res = yield client.stats_slabs()
+        slabs = res['127.0.0.1:11211']['slabs']
+        self.assertIn('chunk_size', slabs[min(slabs)])
+        res = yield client.stats_items()
+        for slab in res['127.0.0.1:11211'].values():
+            self.assertIn('evicted', slab)
+
+    @gen_test
+    def test_stats_collector(self):
+        client = Client(['127.0.0.1:11211'])
+        collector = StatsCollector(client, waste_threshold=0)
+        yield collector.collect()
+        key = uuid.uuid4().hex
+        yield client.set(key, 'x' * 10, 5)
+        yield client.get(key)
+        yield client.get(uuid.uuid4().hex)
+        report = yield collector.collect()
+        host = report['hosts']['127.0.0.1:11211']
+        self.assertGreaterEqual(host['get_hits'], 1)
+        self.assertGreaterEqual(host['get_misses'], 1)
+        self.assertIsNotNone(report['hit_ratio'])
+        self.assertIn('127.0.0.1:11211', report['evictions'])
+        (usage,) = report['value_sizes'].values()
+        self.assertEqual(usage['count'], 1)
+        self.assertEqual(usage['share'], 1.0)
+        # mapped onto the class table from the settings, not onto the
+        # smallest class that happens to have pages
+        self.assertEqual(usage['chunk_size'], 120)
+        self.assertEqual(len(report['warnings']), 1)
+        self.assertEqual(report['errors'], {})
+
+        # a restarted server starts its counters over
+        collector.previous[1]['127.0.0.1:11211']['get_hits'] += 1000000
+        collector.previous[1]['127.0.0.1:11211']['uptime'] += 1000000
+        report = yield collector.collect()
+        host = report['hosts']['127.0.0.1:11211']
+        self.assertTrue(host['restarted'])
+        self.assertGreaterEqual(host['get_hits'], 0)
+
+        # a host that does not answer is reported next to the others
+        client = Client(['127.0.0.1:11211', '127.0.0.1:11212'])
+        stats = client._stats
+
+        def stub_stats(host, args):
+            if host == '127.0.0.1:11212':
+                future = tornado.concurrent.Future()
+                future.set_exception(MemcachedServerError('down'))
+                return future
+            return stats(host, args)
+
+        client._stats = stub_stats
+        report = yield StatsCollector(client).collect()
+        self.assertEqual(report['errors'], {'127.0.0.1:11212': 'down'})
+        self.assertEqual(list(report['hosts']), ['127.0.0.1:11211'])
+        self.assertIsNotNone(report['hit_ratio'])
+
+        classes = slab_classes({'chunk_size': 48, 'growth_factor': 1.25,
+                                'item_size_max': 1024 * 1024})
+        self.assertEqual([classes[i] for i in range(1, 7)],
+                         [96, 120, 152, 192, 240, 304])
+        self.assertEqual(classes[max(classes)], 1024 * 1024)
+
 
 if __name__ == '__main__':
-    import unittest
     unittest.main()
@@ -3,13 +3,19 @@
 
 import cPickle as pickle
 import collections
+import datetime
 import logging
+import math
 import re
+import time
 import zlib
 from binascii import crc32
 from cStringIO import StringIO
+from functools import partial
 
+from namespace import Namespace
 from pool import Pool
+from writebehind import DROP_OLDEST, WriteBuffer
 
 import six
 
@@ -30,6 +36,20 @@ _FLAG_LONG = 1 << 2
 _FLAG_COMPRESSED = 1 << 3
 
 
+def _parse_stat(value):
+    for convert in (int, float):
+        try:
+            return convert(value)
+        except ValueError:
+            pass
+    return value
+
+
+def _inflate_rest(decompressobj):
+    return decompressobj.decompress(decompressobj.unconsumed_tail) + \
+        decompressobj.flush()
+
+
 class MemcachedError(Exception):
     pass
 
@@ -53,15 +73,62 @@ class MemcachedServerError(MemcachedError):
 class Client:
 
     def __init__(self, hosts, io_loop=None, socket_timeout=5,
-                 max_connections=10, max_idle=3, idle_timeout=600):
+                 max_connections=10, max_idle=3, idle_timeout=600,
+                 shared_cache=None, compress_executor=None,
+                 async_compress_threshold=64 * 1024, compress_policy=None,
+                 write_buffer_size=10000,
+                 write_buffer_bytes=64 * 1024 * 1024, write_flush_size=100,
+                 write_drop_policy=DROP_OLDEST, namespace_ttl=1.0,
+                 recorder=None):
         self.hosts = hosts
+        # optional tornmc.shm.SharedCache shared by forked workers
+        self.shared_cache = shared_cache
+        # zlib releases the GIL, so large values are (de)compressed on
+        # this concurrent.futures executor instead of the IOLoop thread
+        self.compress_executor = compress_executor
+        self.async_compress_threshold = async_compress_threshold
+        # optional tornmc.compress.CompressionPolicy
+        self.compress_policy = compress_policy
+        # per host limits of set_nowait, in keys and serialized bytes
+        self.write_buffer_size = write_buffer_size
+        self.write_buffer_bytes = write_buffer_bytes
+        self.write_flush_size = write_flush_size
+        self.write_drop_policy = write_drop_policy
+        # host -> WriteBuffer, created on first set_nowait
+        self.write_buffers = {}
+        self.namespace_ttl = namespace_ttl
+        # namespace name -> (generation, cached until)
+        self.ns_generations = {}
+        # optional tornmc.trace.TraceRecorder
+        self.recorder = recorder
+        # called with (key length, value size) of every value stored,
+        # see tornmc.stats.StatsCollector
+        self.size_observer = None
         io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.io_loop = io_loop
+        self.socket_timeout = socket_timeout
+        self.max_connections = max_connections
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
         self.pools = {}
         for host in hosts:
-            self.pools[host] = Pool(host, io_loop, socket_timeout,
-                                    max_idle=max_idle,
-                                    max_active=max_connections,
-                                    idle_timeout=idle_timeout)
+            self.pools[host] = self._create_pool(host)
+        # state of the last update_hosts(), see _migrating()
+        self.old_hosts = None
+        self.migration_deadline = 0
+        self.migration_id = 0
+        self.copy_forward = False
+        self.copy_expire = 0
+        # pools of removed hosts, closed when the migration window ends
+        self.draining = {}
+        # key -> copy forward in flight
+        self.copying = {}
+
+    def _create_pool(self, host):
+        return Pool(host, self.io_loop, self.socket_timeout,
+                    max_idle=self.max_idle,
+                    max_active=self.max_connections,
+                    idle_timeout=self.idle_timeout)
 
     @tornado.gen.coroutine
     def get(self, key):
@@ -78,7 +145,11 @@ class Client:
     @tornado.gen.coroutine
     def cas(self, key, cas_id, value, expire=0, min_compress_len=0):
         self._check_key(key)
-        flags, value = self.get_store_info(value, min_compress_len)
+        if self.write_buffers:
+            yield self._cancel_pending(key)
+        flags, value = yield self._get_store_info(value, min_compress_len,
+                                                  key)
+        start = time.time()
         connection = yield self.get_connection(key=key)
         try:
             cmd = '%s %s %d %d %d %d\r\n%s' % \
@@ -89,12 +160,40 @@ class Client:
             connection.close()
         except (StandardError, MemcachedError):
             connection.disconnect()
+            self._invalidate(key)
             raise
+        self._invalidate(key)
+        self._record('cas', key, len(value), start)
         raise tornado.gen.Return(response == 'STORED')
 
     @tornado.gen.coroutine
     def _get(self, cmd, key):
-        connection = yield self.get_connection(key=key)
+        if cmd == 'get' and self.shared_cache is not None:
+            cached = self.shared_cache.get(key)
+            if cached is not None:
+                flags, val = yield self._decompress(*cached)
+                raise tornado.gen.Return(self._convert(flags, val))
+            token = self.shared_cache.token(key)
+        raw = yield self._get_raw(cmd, key)
+        if raw is None and self._migrating():
+            raw = yield self._get_migrated(cmd, key)
+        if raw is None:
+            raise tornado.gen.Return(None)
+        flags, val, cas_id = raw
+        if cmd == 'get' and self.shared_cache is not None:
+            self.shared_cache.set(key, flags, val, token=token)
+        flags, val = yield self._decompress(flags, val)
+        result = self._convert(flags, val)
+        if cmd == 'gets':
+            response = (result, cas_id)
+        else:
+            response = result
+        raise tornado.gen.Return(response)
+
+    @tornado.gen.coroutine
+    def _get_raw(self, cmd, key, host=None):
+        start = time.time()
+        connection = yield self.get_connection(key=key, host=host)
         try:
             command = '%s %s' % (cmd, key)
             yield connection.send_cmd(command)
@@ -102,9 +201,12 @@ class Client:
             self._raise_errors(head, cmd)
             if head == 'END':
                 connection.close()
+                self._record(cmd, key, 0, start, host)
                 raise tornado.gen.Return(None)
+            cas_id = None
             if cmd == 'gets':
                 _, _, flags, length, cas_id = head.split(' ')
+                cas_id = int(cas_id)
             else:
                 _, _, flags, length = head.split(' ')
             length = int(length) + 2  # include \r\n
@@ -117,12 +219,33 @@ class Client:
             connection.disconnect()
             raise
         val = val[:-2]  # strip \r\n
-        result = self._convert(flags, val)
-        if cmd == 'gets':
-            response = (result, int(cas_id))
-        else:
-            response = result
-        raise tornado.gen.Return(response)
+        self._record(cmd, key, len(val), start, host)
+        raise tornado.gen.Return((flags, val, cas_id))
+
+    @tornado.gen.coroutine
+    def _cancel_pending(self, key):
+        # a buffered set_nowait must not land after this write
+        for buf in self.write_buffers.values():
+            sent = buf.cancel(key)
+            if sent is not None:
+                yield sent
+
+    def _invalidate(self, key):
+        # call after the write, fills that fetched before it are refused
+        if self.shared_cache is not None:
+            self.shared_cache.delete(key)
+
+    def _record(self, cmd, key, value_size, start, host=None):
+        if self.recorder is None:
+            return
+        try:
+            self.recorder.record(cmd, key, value_size, time.time() - start,
+                                 host or self.get_host(key), start)
+        except Exception as e:
+            # tracing is best effort, never fail the request for it
+            logging.error('trace recorder failed, stop recording. err: %s'
+                          % e)
+            self.recorder = None
 
     def _check_key(self, key, key_prefix=b''):
         if not isinstance(key, six.binary_type):
@@ -173,28 +296,69 @@ class Client:
 
         response = {}
         orig_to_noprefix = dict((key_prefix+str(k), k) for k in keys)
+        raw_values = []
+        shared_cache = self.shared_cache
+        if shared_cache is not None:
+            missing = []
+            tokens = {}
+            for k in keys:
+                key = key_prefix + str(k)
+                cached = shared_cache.get(key)
+                if cached is None:
+                    missing.append(k)
+                    tokens[key] = shared_cache.token(key)
+                else:
+                    raw_values.append((key, cached[0], cached[1]))
+            keys = missing
         key_dict = self._group_keys(keys, key_prefix)
+        fetched = []
         for host, key_list in key_dict.iteritems():
-            connection = yield self.get_connection(host=host)
-            try:
-                cmd = '%s %s' % ('get', ' '.join(key_list))
-                yield connection.send_cmd(cmd)
-                line = yield connection.read_one_line()
-                self._raise_errors(line, 'get')
-                while line and line != 'END':
-                    _, key, flags, length = line.split(' ')
-                    length = int(length) + 2  # include \r\n
-                    flags = int(flags)
-                    val = yield connection.read_bytes(length)
-                    val = val[:-2]  # strip \r\n
-                    response[orig_to_noprefix[key]] = self._convert(flags, val)
-                    line = yield connection.read_one_line()
-                connection.close()
-            except (StandardError, MemcachedError):
-                connection.disconnect()
-                raise
+            values = yield self._get_multi_raw(host, key_list)
+            fetched.extend(values)
+        if self._migrating():
+            found = set(key for key, _, _ in fetched)
+            missing = [key for key_list in key_dict.itervalues()
+                       for key in key_list if key not in found]
+            values = yield self._get_multi_migrated(missing)
+            fetched.extend(values)
+        if shared_cache is not None:
+            for key, flags, val in fetched:
+                shared_cache.set(key, flags, val, token=tokens[key])
+        raw_values.extend(fetched)
+        # decompress after the connections went back to their pools
+        for key, flags, val in raw_values:
+            flags, val = yield self._decompress(flags, val)
+            response[orig_to_noprefix[key]] = self._convert(flags, val)
         raise tornado.gen.Return(response)
 
+    @tornado.gen.coroutine
+    def _get_multi_raw(self, host, key_list):
+        values = []
+        start = time.time()
+        connection = yield self.get_connection(host=host)
+        try:
+            cmd = '%s %s' % ('get', ' '.join(key_list))
+            yield connection.send_cmd(cmd)
+            line = yield connection.read_one_line()
+            self._raise_errors(line, 'get')
+            while line and line != 'END':
+                _, key, flags, length = line.split(' ')
+                length = int(length) + 2  # include \r\n
+                flags = int(flags)
+                val = yield connection.read_bytes(length)
+                val = val[:-2]  # strip \r\n
+                values.append((key, flags, val))
+                line = yield connection.read_one_line()
+            connection.close()
+        except (StandardError, MemcachedError):
+            connection.disconnect()
+            raise
+        if self.recorder is not None:
+            sizes = dict((key, len(val)) for key, _, val in values)
+            for key in key_list:
+                self._record('get', key, sizes.get(key, 0), start, host)
+        raise tornado.gen.Return(values)
+
     def _group_keys(self, keys, key_prefix):
         key_list = [key_prefix + str(k) for k in keys]
         d = collections.defaultdict(list)
@@ -211,7 +375,11 @@ class Client:
         failed_list = []
         for k, value in mapping.iteritems():
             key = key_prefix + str(k)
-            flags, value = self.get_store_info(value, min_compress_len)
+            if self.write_buffers:
+                yield self._cancel_pending(key)
+            flags, value = yield self._get_store_info(value,
+                                                      min_compress_len, key)
+            start = time.time()
             connection = yield self.get_connection(key=key)
             try:
                 cmd = '%s %s %d %d %d\r\n%s' \
@@ -224,7 +392,10 @@ class Client:
                 connection.close()
             except (StandardError, MemcachedError):
                 connection.disconnect()
+                self._invalidate(key)
                 raise
+            self._invalidate(key)
+            self._record('set', key, len(value), start)
             if response != 'STORED':
                 failed_list.append(k)
         raise tornado.gen.Return(failed_list)
@@ -235,6 +406,32 @@ class Client:
         result = yield self._set('set', key, value, expire, min_compress_len)
         raise tornado.gen.Return(result)
 
+    def set_nowait(self, key, value, expire=0, min_compress_len=0):
+        self._check_key(key)
+        buf = self._write_buffer(self.get_host(key))
+        # serialized right away, later changes to value are not written
+        result = buf.put(key, value, expire, min_compress_len)
+        self._invalidate(key)
+        return result
+
+    def _write_buffer(self, host):
+        buf = self.write_buffers.get(host)
+        if buf is None:
+            buf = WriteBuffer(self, host, self.io_loop,
+                              max_pending=self.write_buffer_size,
+                              max_pending_bytes=self.write_buffer_bytes,
+                              flush_size=self.write_flush_size,
+                              drop_policy=self.write_drop_policy)
+            self.write_buffers[host] = buf
+        return buf
+
+    @tornado.gen.coroutine
+    def flush_writes(self):
+        buffers = self.write_buffers.values()
+        while any(buf.pending or buf.flushing for buf in buffers):
+            yield [buf.flush() for buf in buffers]
+            yield tornado.gen.moment
+
     @tornado.gen.coroutine
     def replace(self, key, value, expire=0, min_compress_len=0):
         self._check_key(key)
@@ -250,21 +447,66 @@ class Client:
 
     @tornado.gen.coroutine
     def _set(self, cmd, key, value, expire=0, min_compress_len=0):
-        flags, value = self.get_store_info(value, min_compress_len)
+        if self.write_buffers:
+            yield self._cancel_pending(key)
+        flags, value = yield self._get_store_info(value, min_compress_len,
+                                                  key)
+        result = yield self._store(cmd, key, flags, value, expire)
+        raise tornado.gen.Return(result)
+
+    @tornado.gen.coroutine
+    def _store(self, cmd, key, flags, value, expire=0):
+        start = time.time()
         connection = yield self.get_connection(key=key)
         try:
-            cmd = '%s %s %d %d %d\r\n%s' % \
-                  (cmd, key, flags, expire, len(value), value)
-            yield connection.send_cmd(cmd)
+            command = '%s %s %d %d %d\r\n%s' % \
+                      (cmd, key, flags, expire, len(value), value)
+            yield connection.send_cmd(command)
             response = yield connection.read_one_line()
             self._raise_errors(response, cmd)
             connection.close()
         except (StandardError, MemcachedError):
             connection.disconnect()
+            self._invalidate(key)
             raise
+        self._invalidate(key)
+        self._record(cmd, key, len(value), start)
         raise tornado.gen.Return(response == 'STORED')
 
-    def get_store_info(self, value, min_compress_len):
+    def get_store_info(self, value, min_compress_len, key=None):
+        flags, value, min_compress_len = self._serialize(value,
+                                                         min_compress_len)
+        if self._want_compress(value, min_compress_len, key):
+            flags, value = self._apply_compress(flags, value, key,
+                                                zlib.compress(value))
+        self._observe_size(key, value)
+        return (flags, value)
+
+    @tornado.gen.coroutine
+    def _get_store_info(self, value, min_compress_len, key=None):
+        flags, value, min_compress_len = self._serialize(value,
+                                                         min_compress_len)
+        result = yield self._compress_serialized(flags, value,
+                                                 min_compress_len, key)
+        raise tornado.gen.Return(result)
+
+    @tornado.gen.coroutine
+    def _compress_serialized(self, flags, value, min_compress_len, key=None):
+        if self._want_compress(value, min_compress_len, key):
+            if self._use_executor(value):
+                comp_val = yield self.compress_executor.submit(zlib.compress,
+                                                               value)
+            else:
+                comp_val = zlib.compress(value)
+            flags, value = self._apply_compress(flags, value, key, comp_val)
+        self._observe_size(key, value)
+        raise tornado.gen.Return((flags, value))
+
+    def _observe_size(self, key, value):
+        if self.size_observer is not None:
+            self.size_observer(len(key) if key else 0, len(value))
+
+    def _serialize(self, value, min_compress_len):
         flags = 0
         if isinstance(value, unicode):
             value = value.encode('utf-8')
@@ -284,16 +526,43 @@ class Client:
             pickler = pickle.Pickler(file)
             pickler.dump(value)
             value = file.getvalue()
+        return (flags, value, min_compress_len)
 
-        lv = len(value)
-        if min_compress_len and lv > min_compress_len:
-            comp_val = zlib.compress(value)
-            if len(comp_val) < lv:
-                flags |= _FLAG_COMPRESSED
-                value = comp_val
+    def _want_compress(self, value, min_compress_len, key):
+        if not min_compress_len or len(value) <= min_compress_len:
+            return False
+        if self.compress_policy is None:
+            return True
+        return self.compress_policy.should_compress(key)
 
+    def _apply_compress(self, flags, value, key, comp_val):
+        lv = len(value)
+        if self.compress_policy is not None:
+            self.compress_policy.record(key, lv, len(comp_val))
+        if len(comp_val) < lv:
+            flags |= _FLAG_COMPRESSED
+            value = comp_val
         return (flags, value)
 
+    def _use_executor(self, value):
+        return self.compress_executor is not None and \
+            len(value) >= self.async_compress_threshold
+
+    @tornado.gen.coroutine
+    def _decompress(self, flags, value):
+        if not flags & _FLAG_COMPRESSED or self.compress_executor is None:
+            raise tornado.gen.Return((flags, value))
+        # the compressed size says nothing about the inflated one, so
+        # inflate at most async_compress_threshold bytes on the IOLoop and
+        # hand whatever is left to the executor
+        d = zlib.decompressobj()
+        head = d.decompress(value, self.async_compress_threshold)
+        if d.unconsumed_tail:
+            tail = yield self.compress_executor.submit(_inflate_rest, d)
+        else:
+            tail = d.flush()
+        raise tornado.gen.Return((flags & ~_FLAG_COMPRESSED, head + tail))
+
     @tornado.gen.coroutine
     def incr(self, key, delta=1):
         self._check_key(key)
@@ -309,6 +578,19 @@ class Client:
     @tornado.gen.coroutine
     def delete(self, key):
         self._check_key(key)
+        if self.write_buffers:
+            yield self._cancel_pending(key)
+        migrated = True
+        if self._migrating():
+            old_host = self.get_host(key, self.old_hosts)
+            if old_host != self.get_host(key):
+                # the old host first, or a dual read in between would
+                # bring the value back, then wait for copies it started
+                migrated = yield self._delete_migrated(key, old_host)
+                copying = self.copying.get(key)
+                if copying is not None:
+                    yield copying
+        start = time.time()
         connection = yield self.get_connection(key=key)
         try:
             cmd = 'delete %s' % (key)
@@ -318,38 +600,271 @@ class Client:
             connection.close()
         except (StandardError, MemcachedError):
             connection.disconnect()
+            self._invalidate(key)
             raise
-        raise tornado.gen.Return(response in ('DELETED', 'NOT_FOUND'))
+        self._invalidate(key)
+        self._record('delete', key, 0, start)
+        raise tornado.gen.Return(migrated and
+                                 response in ('DELETED', 'NOT_FOUND'))
 
     @tornado.gen.coroutine
     def _incr_or_decr(self, cmd, key, delta):
+        if self.write_buffers:
+            yield self._cancel_pending(key)
+        start = time.time()
         connection = yield self.get_connection(key=key)
         try:
-            cmd = '%s %s %d' % (cmd, key, delta)
-            yield connection.send_cmd(cmd)
+            command = '%s %s %d' % (cmd, key, delta)
+            yield connection.send_cmd(command)
             response = yield connection.read_one_line()
             self._raise_errors(response, cmd)
-            if not response.isdigit():
-                connection.close()
-                raise tornado.gen.Return(None)
             connection.close()
         except (StandardError, MemcachedError):
             connection.disconnect()
+            self._invalidate(key)
             raise
+        self._invalidate(key)
+        self._record(cmd, key, 0, start)
+        if not response.isdigit():
+            raise tornado.gen.Return(None)
         raise tornado.gen.Return(int(response))
 
-    def get_host(self, key):
+    @tornado.gen.coroutine
+    def stats(self, args='', errors=None):
+        result = yield self._stats_all(args, errors)
+        raise tornado.gen.Return(dict(
+            (host, dict(lines)) for host, lines in result.iteritems()))
+
+    @tornado.gen.coroutine
+    def stats_slabs(self, errors=None):
+        result = yield self._stats_all('slabs', errors)
+        response = {}
+        for host, lines in result.iteritems():
+            slabs = collections.defaultdict(dict)
+            info = {'slabs': slabs}
+            for name, value in lines:
+                if ':' in name:
+                    slab_id, name = name.split(':', 1)
+                    slabs[int(slab_id)][name] = value
+                else:
+                    info[name] = value
+            info['slabs'] = dict(slabs)
+            response[host] = info
+        raise tornado.gen.Return(response)
+
+    @tornado.gen.coroutine
+    def stats_items(self, errors=None):
+        result = yield self._stats_all('items', errors)
+        response = {}
+        for host, lines in result.iteritems():
+            items = collections.defaultdict(dict)
+            for name, value in lines:
+                _, slab_id, name = name.split(':', 2)
+                items[int(slab_id)][name] = value
+            response[host] = dict(items)
+        raise tornado.gen.Return(response)
+
+    @tornado.gen.coroutine
+    def _stats_all(self, args, errors=None):
+        # hosts that fail are left out of the result, and recorded in
+        # errors as host -> message if given. A refused connect never
+        # resolves the connection future, so every host is also bounded
+        # by a connect plus a read timeout
+        deadline = datetime.timedelta(seconds=self.socket_timeout * 2)
+        futures = dict((host, tornado.gen.with_timeout(
+            deadline, self._stats(host, args), self.io_loop))
+            for host in self.hosts)
+        result = {}
+        for host, future in futures.iteritems():
+            try:
+                result[host] = yield future
+            except Exception as e:
+                logging.error('stats %s from %s failed. err: %s'
+                              % (args, host, e))
+                if errors is not None:
+                    errors[host] = str(e)
+        raise tornado.gen.Return(result)
+
+    @tornado.gen.coroutine
+    def _stats(self, host, args):
+        connection = yield self.get_connection(host=host)
+        lines = []
+        try:
+            yield connection.send_cmd(('stats %s' % args).strip())
+            line = yield connection.read_one_line()
+            self._raise_errors(line, 'stats')
+            while line and line != 'END':
+                _, name, value = line.split(' ', 2)
+                lines.append((name, _parse_stat(value)))
+                line = yield connection.read_one_line()
+            connection.close()
+        except (StandardError, MemcachedError):
+            connection.disconnect()
+            raise
+        raise tornado.gen.Return(lines)
+
+    def get_host(self, key, hosts=None):
+        if hosts is None:
+            hosts = self.hosts
         key_hash = server_hash_function(key)
-        return self.hosts[key_hash % len(self.hosts)]
+        return hosts[key_hash % len(hosts)]
+
+    def update_hosts(self, hosts, migration_window=60, copy_forward=False,
+                     copy_expire=None):
+        # get does not return the remaining TTL of an item, so a copy
+        # needs an expiry of its own or it would never expire
+        if copy_expire is None:
+            copy_expire = int(math.ceil(migration_window))
+        if not hosts:
+            raise ValueError('update_hosts requires at least one host')
+        if copy_forward and migration_window > 0 and copy_expire <= 0:
+            raise ValueError('copy_forward requires a positive copy_expire')
+
+        pools = {}
+        for host in hosts:
+            pool = self.pools.get(host) or self.draining.pop(host, None)
+            if pool is None or pool.closed:
+                pool = self._create_pool(host)
+            pools[host] = pool
+        for host, pool in self.pools.iteritems():
+            if host not in pools:
+                self.draining[host] = pool
+
+        # single assignment on the IOLoop thread, no request sees a mix
+        if migration_window > 0:
+            self.old_hosts = self.hosts
+        else:
+            self.old_hosts = None
+        self.hosts = list(hosts)
+        self.pools = pools
+        self.copy_forward = copy_forward
+        self.copy_expire = copy_expire
+        self.migration_deadline = time.time() + migration_window
+        self.migration_id += 1
+
+        # buffered writes follow their keys to the new hosts
+        for host, buf in self.write_buffers.items():
+            for key in [k for k in buf.pending if self.get_host(k) != host]:
+                entry = buf.pop(key)
+                target = self._write_buffer(self.get_host(key))
+                if key not in target.pending:
+                    target.put_serialized(key, entry)
+
+        if migration_window > 0:
+            self.io_loop.add_timeout(self.migration_deadline,
+                                     partial(self._finish_migration,
+                                             self.migration_id))
+        else:
+            self._finish_migration(self.migration_id)
+
+    def _finish_migration(self, migration_id):
+        if migration_id != self.migration_id:
+            return  # superseded by a newer update_hosts
+        logging.info('host migration finished, drain %d pools.'
+                     % len(self.draining))
+        self.old_hosts = None
+        for pool in self.draining.itervalues():
+            pool.close()
+        self.draining = {}
+        for host in self.write_buffers.keys():
+            buf = self.write_buffers[host]
+            if host not in self.pools and not buf.pending and \
+                    not buf.flushing:
+                del self.write_buffers[host]
+
+    def _migrating(self):
+        return self.old_hosts is not None and \
+            self.migration_deadline > time.time()
+
+    @tornado.gen.coroutine
+    def _get_migrated(self, cmd, key):
+        old_host = self.get_host(key, self.old_hosts)
+        if old_host == self.get_host(key):
+            raise tornado.gen.Return(None)
+        try:
+            raw = yield self._get_raw(cmd, key, host=old_host)
+        except Exception as e:
+            logging.warning('read %s from old host %s failed. err: %s'
+                            % (key, old_host, e))
+            raise tornado.gen.Return(None)
+        if raw is not None and self.copy_forward:
+            self._start_copy_forward(key, raw[0], raw[1])
+        raise tornado.gen.Return(raw)
+
+    @tornado.gen.coroutine
+    def _get_multi_migrated(self, keys):
+        hosts = collections.defaultdict(list)
+        for key in keys:
+            old_host = self.get_host(key, self.old_hosts)
+            if old_host != self.get_host(key):
+                hosts[old_host].append(key)
+        values = []
+        for old_host, key_list in hosts.iteritems():
+            try:
+                host_values = yield self._get_multi_raw(old_host, key_list)
+            except Exception as e:
+                logging.warning('read from old host %s failed. err: %s'
+                                % (old_host, e))
+                continue
+            values.extend(host_values)
+        if self.copy_forward:
+            for key, flags, val in values:
+                self._start_copy_forward(key, flags, val)
+        raise tornado.gen.Return(values)
+
+    def _start_copy_forward(self, key, flags, value):
+        # not awaited by the read, but by a delete of the same key
+        future = self._copy_forward(key, flags, value)
+        self.copying[key] = future
+
+        def done(f):
+            if self.copying.get(key) is f:
+                del self.copying[key]
+        future.add_done_callback(done)
+
+    @tornado.gen.coroutine
+    def _copy_forward(self, key, flags, value):
+        # add, so a value written to the new host meanwhile wins
+        try:
+            yield self._store('add', key, flags, value, self.copy_expire)
+        except Exception as e:
+            logging.warning('copy %s to new host failed. err: %s' % (key, e))
+
+    @tornado.gen.coroutine
+    def _delete_migrated(self, key, old_host):
+        try:
+            connection = yield self.get_connection(host=old_host)
+        except Exception as e:
+            logging.warning('delete %s from old host %s failed. err: %s'
+                            % (key, old_host, e))
+            raise tornado.gen.Return(False)
+        try:
+            yield connection.send_cmd('delete %s' % key)
+            response = yield connection.read_one_line()
+            self._raise_errors(response, 'delete')
+            connection.close()
+        except Exception as e:
+            connection.disconnect()
+            logging.warning('delete %s from old host %s failed. err: %s'
+                            % (key, old_host, e))
+            raise tornado.gen.Return(False)
+        raise tornado.gen.Return(response in ('DELETED', 'NOT_FOUND'))
 
     @tornado.gen.coroutine
     def get_connection(self, key=None, host=None):
         if host is None:
             host = self.get_host(key)
-        pool = self.pools[host]
+        pool = self.pools.get(host)
+        if pool is None:
+            pool = self.draining[host]
         c = yield pool.get_connection()
         raise tornado.gen.Return(c)
 
+    def namespace(self, name):
+        return Namespace(self, name)
+
     def disconnect_all(self):
         for _, pool in self.pools.iteritems():
             pool.close()
+        for _, pool in self.draining.iteritems():
+            pool.close()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re
+from collections import OrderedDict
+
+
+_prefix_re = re.compile(b'[:_.]')
+
+
+def default_key_prefix(key):
+    m = _prefix_re.search(key)
+    if m is None:
+        # uuid/hex style keys without a prefix share one bucket
+        return b''
+    return key[:m.start()]
+
+
+class CompressionPolicy(object):
+    """Adaptive compress decision, sampled per key prefix.
+
+    The first ``sample_size`` values of a prefix are always compressed and
+    their ratio recorded. Once the average ratio is worse than ``min_ratio``
+    compression is skipped for that prefix, and resampled after
+    ``resample_interval`` skipped values in case the data changed. At most
+    ``max_prefixes`` prefixes are tracked, the least recently used one is
+    forgotten to make room for a new prefix.
+    """
+
+    def __init__(self, min_ratio=0.9, sample_size=20, resample_interval=1000,
+                 max_prefixes=1024, key_prefix=default_key_prefix):
+        self.min_ratio = min_ratio
+        self.sample_size = sample_size
+        self.resample_interval = resample_interval
+        self.max_prefixes = max_prefixes
+        self.key_prefix = key_prefix
+        # prefix -> [samples, raw bytes, compressed bytes, skipped],
+        # ordered from least to most recently used
+        self.prefixes = OrderedDict()
+
+    def _touch(self, prefix):
+        stat = self.prefixes.pop(prefix, None)
+        if stat is not None:
+            self.prefixes[prefix] = stat
+        return stat
+
+    def should_compress(self, key):
+        if key is None:
+            return True
+        stat = self._touch(self.key_prefix(key))
+        if stat is None or stat[0] < self.sample_size:
+            return True
+        if stat[2] <= stat[1] * self.min_ratio:
+            return True
+        stat[3] += 1
+        if stat[3] >= self.resample_interval:
+            stat[:] = [0, 0, 0, 0]
+            return True
+        return False
+
+    def record(self, key, raw_len, compressed_len):
+        if key is None:
+            return
+        prefix = self.key_prefix(key)
+        stat = self._touch(prefix)
+        if stat is None:
+            if len(self.prefixes) >= self.max_prefixes:
+                self.prefixes.popitem(last=False)
+            stat = self.prefixes[prefix] = [0, 0, 0, 0]
+        if stat[0] >= self.sample_size:
+            return
+        stat[0] += 1
+        stat[1] += raw_len
+        stat[2] += compressed_len
+
+    def ratio(self, key_prefix):
+        stat = self.prefixes.get(key_prefix)
+        if not stat or not stat[1]:
+            return None
+        return float(stat[2]) / stat[1]
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+
+import tornado.gen
+
+
+class Namespace(object):
+    """Keys transparently prefixed with a namespace generation.
+
+    The generation number lives in memcached under ``generation_key`` and
+    is cached by the client for ``Client.namespace_ttl`` seconds, so reads
+    cost no extra round trip. ``invalidate`` is a single ``incr``: every
+    key written under the old generation becomes unreachable at once and
+    is left to expire or be evicted. Other processes pick up the new
+    generation once their cached copy expires.
+    """
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.generation_key = 'ns:%s' % name
+
+    @tornado.gen.coroutine
+    def generation(self):
+        cached = self.client.ns_generations.get(self.name)
+        if cached is not None and cached[1] > time.time():
+            raise tornado.gen.Return(cached[0])
+        gen = yield self.client.get(self.generation_key)
+        if gen is None:
+            gen = yield self._init_generation()
+        self._cache_generation(gen)
+        raise tornado.gen.Return(gen)
+
+    @tornado.gen.coroutine
+    def _init_generation(self):
+        # the clock, but never below a generation this client has seen,
+        # so an evicted counter does not revive the keys of an older one
+        gen = int(time.time())
+        cached = self.client.ns_generations.get(self.name)
+        if cached is not None:
+            gen = max(gen, cached[0] + 1)
+        for _ in range(3):
+            added = yield self.client.add(self.generation_key, gen)
+            if added:
+                raise tornado.gen.Return(gen)
+            current = yield self.client.get(self.generation_key)
+            if current is not None:
+                raise tornado.gen.Return(current)
+        # the counter keeps vanishing, use the seed for this process
+        raise tornado.gen.Return(gen)
+
+    def _cache_generation(self, gen):
+        self.client.ns_generations[self.name] = \
+            (gen, time.time() + self.client.namespace_ttl)
+
+    @tornado.gen.coroutine
+    def key_prefix(self):
+        gen = yield self.generation()
+        raise tornado.gen.Return('%s:%d:' % (self.name, gen))
+
+    @tornado.gen.coroutine
+    def invalidate(self):
+        gen = yield self.client.incr(self.generation_key)
+        if gen is None:
+            gen = yield self._init_generation()
+        self._cache_generation(gen)
+        raise tornado.gen.Return(gen)
+
+    @tornado.gen.coroutine
+    def get(self, key):
+        prefix = yield self.key_prefix()
+        result = yield self.client.get(prefix + key)
+        raise tornado.gen.Return(result)
+
+    @tornado.gen.coroutine
+    def set(self, key, value, expire=0, min_compress_len=0):
+        prefix = yield self.key_prefix()
+        result = yield self.client.set(prefix + key, value, expire,
+                                       min_compress_len)
+        raise tornado.gen.Return(result)
+
+    @tornado.gen.coroutine
+    def add(self, key, value, expire=0, min_compress_len=0):
+        prefix = yield self.key_prefix()
+        result = yield self.client.add(prefix + key, value, expire,
+                                       min_compress_len)
+        raise tornado.gen.Return(result)
+
+    @tornado.gen.coroutine
+    def replace(self, key, value, expire=0, min_compress_len=0):
+        prefix = yield self.key_prefix()
+        result = yield self.client.replace(prefix + key, value, expire,
+                                           min_compress_len)
+        raise tornado.gen.Return(result)
+
+    @tornado.gen.coroutine
+    def delete(self, key):
+        prefix = yield self.key_prefix()
+        result = yield self.client.delete(prefix + key)
+        raise tornado.gen.Return(result)
+
+    @tornado.gen.coroutine
+    def get_multi(self, keys):
+        prefix = yield self.key_prefix()
+        result = yield self.client.get_multi(keys, key_prefix=prefix)
+        raise tornado.gen.Return(result)
+
+    @tornado.gen.coroutine
+    def set_multi(self, mapping, expire=0, min_compress_len=0):
+        prefix = yield self.key_prefix()
+        result = yield self.client.set_multi(mapping, expire,
+                                             key_prefix=prefix,
+                                             min_compress_len=min_compress_len)
+        raise tornado.gen.Return(result)
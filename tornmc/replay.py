@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Replays a trace recorded by tornmc.trace.TraceRecorder.
+
+    python -m tornmc.replay --hosts 127.0.0.1:11211 --speed 2 trace.bin
+"""
+
+import argparse
+import collections
+import logging
+import time
+
+import tornado.gen
+import tornado.ioloop
+
+from tornmc.client import Client
+from tornmc.trace import read_trace
+
+
+def _percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    idx = int(round(p * (len(sorted_values) - 1)))
+    return sorted_values[idx]
+
+
+def _payload(value_size):
+    # the trace only has sizes, keep values memcached can incr/decr
+    # (at most 20 digits) numeric so counter keys replay without errors
+    if value_size <= 20:
+        return '1' * value_size
+    return 'x' * value_size
+
+
+@tornado.gen.coroutine
+def _execute(client, cmd, key, value_size):
+    if cmd in ('get', 'gets'):
+        yield client.get(key)
+    elif cmd in ('add', 'replace'):
+        yield getattr(client, cmd)(key, _payload(value_size))
+    elif cmd in ('set', 'cas'):
+        yield client.set(key, _payload(value_size))
+    elif cmd == 'delete':
+        yield client.delete(key)
+    else:
+        yield getattr(client, cmd)(key)
+
+
+@tornado.gen.coroutine
+def replay(path, client, speed=1.0, concurrency=10):
+    """Drives the trace at ``path`` against ``client``.
+
+    ``speed`` scales the recorded inter-arrival times, 0 replays as fast
+    as ``concurrency`` allows. Returns a report dict, see format_report.
+    """
+    records = read_trace(path)
+    latencies = []
+    host_ops = collections.Counter()
+    errors = collections.Counter()
+    state = {'trace_start': None}
+    start = time.time()
+
+    @tornado.gen.coroutine
+    def worker():
+        for ts, cmd, key_hash, value_size, _, _ in records:
+            if state['trace_start'] is None:
+                state['trace_start'] = ts
+            if speed:
+                deadline = start + (ts - state['trace_start']) / speed
+                if deadline > time.time():
+                    yield tornado.gen.Task(client.io_loop.add_timeout,
+                                           deadline)
+            key = 'trace_%08x' % key_hash
+            host_ops[client.get_host(key)] += 1
+            op_start = time.time()
+            try:
+                yield _execute(client, cmd, key, value_size)
+            except Exception as e:
+                errors[type(e).__name__] += 1
+                logging.debug('replay %s %s failed. err: %s' % (cmd, key, e))
+                continue
+            latencies.append(time.time() - op_start)
+
+    yield [worker() for _ in range(concurrency)]
+    elapsed = time.time() - start
+
+    latencies.sort()
+    ops = len(latencies) + sum(errors.values())
+    mean_load = float(ops) / len(client.hosts) if client.hosts else 0
+    skew = max(host_ops.values() or [0]) / mean_load if mean_load else 0
+    raise tornado.gen.Return({
+        'ops': ops,
+        'errors': dict(errors),
+        'elapsed': elapsed,
+        'throughput': ops / elapsed if elapsed else 0,
+        'latency': dict((name, _percentile(latencies, p)) for name, p in (
+            ('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('p999', 0.999),
+            ('max', 1.0))),
+        'host_ops': dict((host, host_ops[host]) for host in client.hosts),
+        'skew': skew,
+    })
+
+
+def format_report(report):
+    lines = ['ops: %d  errors: %d  elapsed: %.2fs  throughput: %.1f ops/s'
+             % (report['ops'], sum(report['errors'].values()),
+                report['elapsed'], report['throughput'])]
+    latency = report['latency']
+    lines.append('latency ms: ' + '  '.join(
+        '%s %.3f' % (name, latency[name] * 1000)
+        for name in ('p50', 'p90', 'p99', 'p999', 'max')))
+    for host, ops in sorted(report['host_ops'].items()):
+        lines.append('  %s: %d ops' % (host, ops))
+    lines.append('load skew (max/mean): %.2f' % report['skew'])
+    for name, count in sorted(report['errors'].items()):
+        lines.append('  %s: %d' % (name, count))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('trace')
+    parser.add_argument('--hosts', required=True,
+                        help='comma separated host:port list')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay speed multiplier, 0 for max speed')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--max-connections', type=int, default=10)
+    args = parser.parse_args()
+
+    client = Client(args.hosts.split(','),
+                    max_connections=args.max_connections)
+    io_loop = tornado.ioloop.IOLoop.current()
+    report = io_loop.run_sync(lambda: replay(args.trace, client, args.speed,
+                                             args.concurrency))
+    print(format_report(report))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import mmap
+import multiprocessing
+import struct
+import time
+from binascii import crc32
+
+
+# bumped by every delete of the slot, never written by set
+_EPOCH = struct.Struct('=I')
+# version, epoch stamp, expire_at, flags, key_len, value_len
+_HEADER = struct.Struct('=IIdIHI')
+_VERSION = _EPOCH
+_MAX_KEY_LEN = 250
+
+
+class SharedCache(object):
+    """Fixed-size hash table living in an anonymous shared mmap.
+
+    It must be created before ``tornado.process.fork_processes`` so every
+    worker inherits the same segment. Each slot is guarded by a seqlock:
+    writers bump the version to an odd number, write, then bump it to the
+    next even number. Readers never retry, a torn read is just a miss.
+    Writers of the same slot are serialized with non-blocking striped
+    locks, a write that loses the race is simply dropped.
+
+    Invalidation never takes a lock. ``delete`` bumps the slot epoch and
+    an entry is only valid while it is stamped with the current epoch.
+    A fill passes the ``token`` taken before its fetch and is refused if
+    the slot was invalidated in between, so a value read before a write
+    cannot be cached after it.
+    """
+
+    def __init__(self, slots=4096, max_value_size=4096, ttl=1.0,
+                 lock_stripes=16):
+        self.slots = slots
+        self.max_value_size = max_value_size
+        self.ttl = ttl
+        self.slot_size = _EPOCH.size + _HEADER.size + _MAX_KEY_LEN + \
+            max_value_size
+        self.mm = mmap.mmap(-1, self.slots * self.slot_size)
+        self.locks = [multiprocessing.Lock() for _ in range(lock_stripes)]
+        self.hits = 0
+        self.misses = 0
+
+    def _slot(self, key):
+        idx = (crc32(key) & 0xffffffff) % self.slots
+        return idx, idx * self.slot_size
+
+    def token(self, key):
+        _, offset = self._slot(key)
+        return _EPOCH.unpack_from(self.mm, offset)[0]
+
+    def get(self, key):
+        _, offset = self._slot(key)
+        mm = self.mm
+        epoch = _EPOCH.unpack_from(mm, offset)[0]
+        offset += _EPOCH.size
+        version, stamp, expire_at, flags, key_len, value_len = \
+            _HEADER.unpack_from(mm, offset)
+        if version & 1 or stamp != epoch or expire_at < time.time():
+            self.misses += 1
+            return None
+        start = offset + _HEADER.size
+        stored_key = mm[start:start + key_len]
+        start += _MAX_KEY_LEN
+        value = mm[start:start + value_len]
+        if _VERSION.unpack_from(mm, offset)[0] != version or \
+                _EPOCH.unpack_from(mm, offset - _EPOCH.size)[0] != epoch or \
+                stored_key != key:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return flags, value
+
+    def set(self, key, flags, value, ttl=None, token=None):
+        if len(key) > _MAX_KEY_LEN or len(value) > self.max_value_size:
+            return False
+        if ttl is None:
+            ttl = self.ttl
+        idx, offset = self._slot(key)
+        lock = self.locks[idx % len(self.locks)]
+        if not lock.acquire(False):
+            return False
+        try:
+            mm = self.mm
+            epoch = _EPOCH.unpack_from(mm, offset)[0]
+            if token is not None and token != epoch:
+                return False
+            offset += _EPOCH.size
+            version = _VERSION.unpack_from(mm, offset)[0]
+            _VERSION.pack_into(mm, offset, version + 1)
+            # stamped with the epoch checked above, a delete racing with
+            # this write leaves the entry invalid
+            _HEADER.pack_into(mm, offset, version + 1, epoch,
+                              time.time() + ttl, flags, len(key), len(value))
+            start = offset + _HEADER.size
+            mm[start:start + len(key)] = key
+            start += _MAX_KEY_LEN
+            mm[start:start + len(value)] = value
+            _VERSION.pack_into(mm, offset, (version + 2) & 0xffffffff)
+        finally:
+            lock.release()
+        return True
+
+    def delete(self, key):
+        _, offset = self._slot(key)
+        # racing deletes may both write epoch + 1, the entry is still stale
+        epoch = _EPOCH.unpack_from(self.mm, offset)[0]
+        _EPOCH.pack_into(self.mm, offset, (epoch + 1) & 0xffffffff)
+
+    def close(self):
+        self.mm.close()
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import collections
+import logging
+import time
+
+import tornado.gen
+import tornado.ioloop
+
+
+# rough per item cost on top of key and value: item header, cas, flags
+# and the trailing \r\n, see memcached's items.c
+ITEM_OVERHEAD = 56
+# sizeof(item) on 64 bit, the base of the smallest slab class
+ITEM_HEADER = 48
+CHUNK_ALIGN_BYTES = 8
+MAX_NUMBER_OF_SLAB_CLASSES = 64
+
+
+def slab_classes(settings):
+    """Returns {slab id: chunk size} the way memcached's slabs_init
+    builds the table from ``stats settings``.
+
+    ``stats slabs`` only lists classes that have pages allocated, so it
+    cannot tell which class a new item of a given size will land in.
+    """
+    factor = settings['growth_factor']
+    largest = settings.get('slab_chunk_max') or settings['item_size_max']
+    sizes = []
+    size = ITEM_HEADER + settings['chunk_size']
+    while len(sizes) < MAX_NUMBER_OF_SLAB_CLASSES - 2 and \
+            size < largest / factor:
+        if size % CHUNK_ALIGN_BYTES:
+            size += CHUNK_ALIGN_BYTES - size % CHUNK_ALIGN_BYTES
+        sizes.append(size)
+        size = int(size * factor)
+    sizes.append(largest)
+    return dict(enumerate(sizes, 1))
+
+
+class StatsCollector(object):
+    """Periodically samples cluster stats and analyses slab usage.
+
+    Every ``interval`` seconds it fetches ``stats``, ``stats settings``,
+    ``stats slabs`` and ``stats items`` from every host and builds
+    ``self.report`` with the cluster-wide hit ratio, per host memory usage,
+    per slab eviction rates and how the values written through the client
+    since the previous sample map to the slab classes memcached derives
+    from its settings, whether or not a class has pages yet. It logs a
+    warning for slab classes that take a significant share of our writes
+    and either waste more than ``waste_threshold`` of each chunk or evict
+    more than ``eviction_threshold`` items per second.
+
+    Hosts that fail to answer are listed in ``report['errors']`` and the
+    report covers the others. A host whose ``pid`` changed or whose
+    ``uptime`` went down restarted during the interval, its counters are
+    taken as they are instead of diffed against the previous sample.
+    """
+
+    def __init__(self, client, interval=60, waste_threshold=0.25,
+                 eviction_threshold=1.0, min_share=0.05):
+        self.client = client
+        self.interval = interval
+        self.waste_threshold = waste_threshold
+        self.eviction_threshold = eviction_threshold
+        self.min_share = min_share
+        # item size -> count, reset after every sample
+        self.item_sizes = collections.Counter()
+        self.previous = None
+        self.report = None
+        self.periodic = None
+        client.size_observer = self.observe_value_size
+
+    def observe_value_size(self, key_len, value_size):
+        self.item_sizes[key_len + value_size + ITEM_OVERHEAD] += 1
+
+    def start(self):
+        if self.periodic is None:
+            self.periodic = tornado.ioloop.PeriodicCallback(
+                self._collect, self.interval * 1000, self.client.io_loop)
+            self.periodic.start()
+
+    def stop(self):
+        if self.periodic is not None:
+            self.periodic.stop()
+            self.periodic = None
+
+    @tornado.gen.coroutine
+    def _collect(self):
+        try:
+            yield self.collect()
+        except Exception as e:
+            logging.error('collect memcached stats failed. err: %s' % e)
+
+    @tornado.gen.coroutine
+    def collect(self):
+        client = self.client
+        # host -> error, hosts that fail are reported without their stats
+        errors = {}
+        stats, settings, slabs, items = yield [
+            client.stats(errors=errors), client.stats('settings', errors),
+            client.stats_slabs(errors), client.stats_items(errors)]
+        now = time.time()
+        item_sizes, self.item_sizes = self.item_sizes, collections.Counter()
+
+        previous = self.previous
+        self.previous = (now, stats, items)
+        restarted = self._restarted(stats, previous)
+        report = {
+            'time': now,
+            'hosts': self._host_report(stats, previous, restarted),
+            'evictions': self._eviction_rates(now, items, previous,
+                                              restarted),
+            'value_sizes': self._slab_usage(settings, slabs, item_sizes),
+            'errors': errors,
+            'warnings': [],
+        }
+        hits = sum(h['get_hits'] for h in report['hosts'].itervalues())
+        misses = sum(h['get_misses'] for h in report['hosts'].itervalues())
+        report['hit_ratio'] = _ratio(hits, hits + misses)
+        used = [h['bytes'] for h in report['hosts'].itervalues()]
+        mean = float(sum(used)) / len(used) if used else 0
+        report['memory_skew'] = max(used) / mean if mean else None
+
+        self._warn(report)
+        self.report = report
+        raise tornado.gen.Return(report)
+
+    def _restarted(self, stats, previous):
+        # counters start over with the process, an interval spanning a
+        # restart is reported from the counters since the restart
+        restarted = set()
+        if previous is None:
+            return restarted
+        for host, host_stats in stats.iteritems():
+            prev = previous[1].get(host)
+            if prev is None:
+                continue
+            if host_stats.get('pid') != prev.get('pid') or \
+                    host_stats.get('uptime', 0) < prev.get('uptime', 0):
+                restarted.add(host)
+        return restarted
+
+    def _host_report(self, stats, previous, restarted):
+        hosts = {}
+        for host, host_stats in stats.iteritems():
+            hits = host_stats.get('get_hits', 0)
+            misses = host_stats.get('get_misses', 0)
+            # counters are cumulative, report the delta of this interval
+            if previous is not None and host in previous[1] and \
+                    host not in restarted:
+                hits -= previous[1][host].get('get_hits', 0)
+                misses -= previous[1][host].get('get_misses', 0)
+            used = host_stats.get('bytes', 0)
+            limit = host_stats.get('limit_maxbytes', 0)
+            hosts[host] = {
+                'get_hits': hits,
+                'get_misses': misses,
+                'hit_ratio': _ratio(hits, hits + misses),
+                'bytes': used,
+                'limit_maxbytes': limit,
+                'memory_usage': _ratio(used, limit),
+                'restarted': host in restarted,
+            }
+        return hosts
+
+    def _eviction_rates(self, now, items, previous, restarted):
+        rates = {}
+        if previous is None:
+            return rates
+        elapsed = now - previous[0]
+        for host, slabs in items.iteritems():
+            prev_slabs = {} if host in restarted else previous[2].get(host, {})
+            host_rates = {}
+            for slab_id, slab in slabs.iteritems():
+                prev = prev_slabs.get(slab_id, {}).get('evicted', 0)
+                host_rates[slab_id] = \
+                    max(slab.get('evicted', 0) - prev, 0) / elapsed
+            rates[host] = host_rates
+        return rates
+
+    def _slab_classes(self, settings, slabs):
+        # slab classes are the same on every host started with the same
+        # settings, take the first host that reports them
+        for host_settings in settings.itervalues():
+            if all(name in host_settings for name in (
+                    'chunk_size', 'growth_factor', 'item_size_max')):
+                classes = slab_classes(host_settings)
+                return (sorted((size, slab_id)
+                               for slab_id, size in classes.iteritems()),
+                        host_settings['item_size_max'])
+        # servers without the settings, fall back to the active classes
+        logging.warning('stats settings incomplete, slab usage is only '
+                        'mapped onto active slab classes')
+        for info in slabs.itervalues():
+            chunk_sizes = sorted((slab['chunk_size'], slab_id)
+                                 for slab_id, slab in info['slabs'].iteritems()
+                                 if 'chunk_size' in slab)
+            if chunk_sizes:
+                return chunk_sizes, chunk_sizes[-1][0]
+        return [], 0
+
+    def _slab_usage(self, settings, slabs, item_sizes):
+        chunk_sizes, item_size_max = self._slab_classes(settings, slabs)
+        usage = {}
+        for size, count in item_sizes.iteritems():
+            for chunk_size, slab_id in chunk_sizes:
+                if chunk_size >= size:
+                    break
+            else:
+                if chunk_sizes and size <= item_size_max:
+                    # larger items are chained from chunks of the
+                    # largest class
+                    chunk_size, slab_id = chunk_sizes[-1]
+                    size = chunk_size
+                else:
+                    slab_id, chunk_size = None, None  # too large
+            u = usage.setdefault(slab_id, {'chunk_size': chunk_size,
+                                           'count': 0, 'wasted': 0})
+            u['count'] += count
+            if chunk_size:
+                u['wasted'] += (chunk_size - size) * count
+
+        total = sum(item_sizes.itervalues())
+        for u in usage.itervalues():
+            u['share'] = _ratio(u['count'], total)
+            chunk_bytes = (u['chunk_size'] or 0) * u['count']
+            u['waste'] = _ratio(u.pop('wasted'), chunk_bytes)
+        return usage
+
+    def _warn(self, report):
+        warnings = report['warnings']
+        for slab_id, u in report['value_sizes'].iteritems():
+            if u['share'] < self.min_share:
+                continue
+            if slab_id is None:
+                warnings.append('%.0f%% of values are larger than the '
+                                'largest slab class' % (u['share'] * 100))
+                continue
+            if u['waste'] > self.waste_threshold:
+                warnings.append('slab class %d (chunk %d bytes) takes %.0f%% '
+                                'of values and wastes %.0f%% of its memory'
+                                % (slab_id, u['chunk_size'], u['share'] * 100,
+                                   u['waste'] * 100))
+            for host, rates in report['evictions'].iteritems():
+                rate = rates.get(slab_id, 0)
+                if rate > self.eviction_threshold:
+                    warnings.append('slab class %d takes %.0f%% of values '
+                                    'and evicts %.1f items/s on %s'
+                                    % (slab_id, u['share'] * 100, rate, host))
+        for warning in warnings:
+            logging.warning(warning)
+
+
+def _ratio(part, total):
+    if not total:
+        return None
+    return float(part) / total
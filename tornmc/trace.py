@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import random
+import struct
+import time
+from binascii import crc32
+
+
+TRACE_MAGIC = b'TMCTRACE1\n'
+
+COMMANDS = ('get', 'gets', 'set', 'add', 'replace', 'cas', 'delete',
+            'incr', 'decr')
+_COMMAND_CODES = dict((cmd, i) for i, cmd in enumerate(COMMANDS))
+
+# tag, host index, host length; followed by the host
+_HOST_RECORD = struct.Struct('!cBH')
+# tag, timestamp, command, key hash, value size, latency, host index
+_CMD_RECORD = struct.Struct('!cdBIIfB')
+
+
+class TraceError(Exception):
+    pass
+
+
+class TraceRecorder(object):
+    """Samples client commands into a compact binary trace file.
+
+    Keys are stored as crc32 hashes only, values only by size. Hosts are
+    written once, the first time they are seen, and referred to by index.
+    Commands are stamped with the time they were issued, ``start``, so a
+    replay keeps the original arrival pattern.
+    """
+
+    def __init__(self, path, sample_rate=1.0):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.host_index = {}
+        self.file = open(path, 'wb', 64 * 1024)
+        self.file.write(TRACE_MAGIC)
+
+    def record(self, cmd, key, value_size, latency, host, start=None):
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        idx = self.host_index.get(host)
+        if idx is None:
+            idx = len(self.host_index)
+            if idx > 0xff:
+                raise TraceError('too many hosts in trace: %s' % host)
+            self.host_index[host] = idx
+            self.file.write(_HOST_RECORD.pack(b'H', idx, len(host)) + host)
+        if start is None:
+            start = time.time() - latency
+        self.file.write(_CMD_RECORD.pack(b'C', start,
+                                         _COMMAND_CODES[cmd],
+                                         crc32(key) & 0xffffffff,
+                                         value_size, latency, idx))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_trace(path):
+    """Yields (timestamp, cmd, key_hash, value_size, latency, host)."""
+    hosts = {}
+    with open(path, 'rb') as f:
+        if f.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise TraceError('not a trace file: %s' % path)
+        while True:
+            tag = f.read(1)
+            if not tag:
+                break
+            if tag == b'H':
+                data = f.read(_HOST_RECORD.size - 1)
+                if len(data) < _HOST_RECORD.size - 1:
+                    break  # truncated by an unclean shutdown
+                _, idx, length = _HOST_RECORD.unpack(tag + data)
+                host = f.read(length)
+                if len(host) < length:
+                    break
+                hosts[idx] = host
+            elif tag == b'C':
+                data = f.read(_CMD_RECORD.size - 1)
+                if len(data) < _CMD_RECORD.size - 1:
+                    break  # truncated by an unclean shutdown
+                _, ts, code, key_hash, value_size, latency, idx = \
+                    _CMD_RECORD.unpack(tag + data)
+                yield (ts, COMMANDS[code], key_hash, value_size, latency,
+                       hosts.get(idx))
+            else:
+                raise TraceError('corrupt trace file: %s' % path)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+from collections import OrderedDict
+
+import tornado.concurrent
+import tornado.gen
+
+
+DROP_OLDEST = 'oldest'
+DROP_NEWEST = 'newest'
+
+
+class WriteBuffer(object):
+    """Per-host buffer of fire-and-forget sets.
+
+    Values are serialized by ``put``, so the caller may change them right
+    away; compression is left to the flush. Writes to a key still pending
+    are coalesced, last write wins. Pending writes are flushed on the next
+    IOLoop tick as pipelined ``noreply`` sets, at most ``flush_size``
+    commands per write. Once ``max_pending`` keys or ``max_pending_bytes``
+    serialized bytes are buffered, ``drop_policy`` decides whether the
+    oldest pending writes or the incoming one are dropped.
+
+    Every batch ends with a ``version`` command, and the reply is read
+    before the connection goes back to the pool. Error lines the server
+    sends for the noreply sets therefore end up here, and those writes
+    count as dropped. A synchronous write of the same key cancels the
+    buffered one through ``cancel``.
+    """
+
+    def __init__(self, client, host, io_loop, max_pending=10000,
+                 max_pending_bytes=64 * 1024 * 1024, flush_size=100,
+                 drop_policy=DROP_OLDEST):
+        if drop_policy not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError('unknown drop policy: %s' % drop_policy)
+        self.client = client
+        self.host = host
+        self.io_loop = io_loop
+        self.max_pending = max_pending
+        self.max_pending_bytes = max_pending_bytes
+        self.flush_size = flush_size
+        self.drop_policy = drop_policy
+        # key -> (flags, serialized value, expire, min_compress_len)
+        self.pending = OrderedDict()
+        self.pending_bytes = 0
+        # popped from pending, serialized but not on the wire yet
+        self.inflight = {}
+        # resolved once the batch currently on the wire got its reply
+        self.sent = None
+        self.flushing = False
+        self.scheduled = False
+        self.flushed = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    def put(self, key, value, expire=0, min_compress_len=0):
+        flags, value, min_compress_len = self.client._serialize(
+            value, min_compress_len)
+        return self.put_serialized(key, (flags, value, expire,
+                                         min_compress_len))
+
+    def put_serialized(self, key, entry):
+        size = len(entry[1])
+        old = self.pending.get(key)
+        if old is not None:
+            # a coalesced write only needs room for the size difference
+            size -= len(old[1])
+        if len(entry[1]) > self.max_pending_bytes or (
+                self.drop_policy == DROP_NEWEST and
+                self._full(old is None, size)):
+            self.dropped += 1
+            return False
+        if old is not None:
+            self.coalesced += 1
+            self.pop(key)
+        while self.pending and self._full(True, len(entry[1])):
+            self.dropped += 1
+            self.pop(next(iter(self.pending)))
+        self.pending[key] = entry
+        self.pending_bytes += len(entry[1])
+        self._schedule()
+        return True
+
+    def _full(self, new_key, size):
+        return (new_key and len(self.pending) >= self.max_pending) or \
+            self.pending_bytes + size > self.max_pending_bytes
+
+    def pop(self, key):
+        entry = self.pending.pop(key, None)
+        if entry is not None:
+            self.pending_bytes -= len(entry[1])
+        return entry
+
+    def cancel(self, key):
+        self.pop(key)
+        if key in self.inflight:
+            if self.sent is not None:
+                return self.sent  # too late, wait until it landed
+            del self.inflight[key]
+        return None
+
+    def _schedule(self):
+        if not self.scheduled and not self.flushing:
+            self.scheduled = True
+            self.io_loop.add_callback(self.flush)
+
+    @tornado.gen.coroutine
+    def flush(self):
+        self.scheduled = False
+        if self.flushing:
+            return
+        self.flushing = True
+        try:
+            while self.pending:
+                batch = []
+                while self.pending and len(batch) < self.flush_size:
+                    key, entry = self.pending.popitem(last=False)
+                    self.pending_bytes -= len(entry[1])
+                    batch.append((key, entry))
+                try:
+                    yield self._send(batch)
+                except Exception as e:
+                    logging.error('write-behind flush to %s failed. err: %s'
+                                  % (self.host, e))
+        finally:
+            self.flushing = False
+
+    @tornado.gen.coroutine
+    def _send(self, batch):
+        client = self.client
+        self.inflight = OrderedDict(batch)
+        cmds = {}
+        for key, (flags, value, expire, min_compress_len) in batch:
+            try:
+                flags, value = yield client._compress_serialized(
+                    flags, value, min_compress_len, key)
+            except Exception as e:
+                logging.error('write-behind compress %s failed. err: %s'
+                              % (key, e))
+                self.inflight.pop(key, None)
+                self.dropped += 1
+                continue
+            cmds[key] = ('set %s %d %d %d noreply\r\n%s'
+                         % (key, flags, expire, len(value), value),
+                         len(value))
+        start = time.time()
+        try:
+            connection = yield client.get_connection(host=self.host)
+        except Exception as e:
+            logging.error('write-behind flush to %s failed. err: %s'
+                          % (self.host, e))
+            self.dropped += len(self.inflight)
+            self.inflight = {}
+            return
+        # whatever was cancelled meanwhile is left out
+        keys = list(self.inflight)
+        if not keys:
+            self.inflight = {}
+            connection.close()
+            return
+        self.sent = tornado.concurrent.Future()
+        errors = 0
+        try:
+            yield connection.send_cmd('\r\n'.join(cmds[key][0] for key in keys)
+                                      + '\r\nversion')
+            line = yield connection.read_one_line()
+            while not line.startswith('VERSION'):
+                logging.error('write-behind set to %s failed. err: %s'
+                              % (self.host, line))
+                errors += 1
+                line = yield connection.read_one_line()
+            connection.close()
+        except Exception as e:
+            connection.disconnect()
+            logging.error('write-behind flush to %s failed. err: %s'
+                          % (self.host, e))
+            errors = len(keys)
+        finally:
+            for key in keys:
+                client._invalidate(key)
+            self.inflight = {}
+            sent, self.sent = self.sent, None
+            sent.set_result(None)
+        errors = min(errors, len(keys))
+        self.dropped += errors
+        self.flushed += len(keys) - errors
+        for key in keys:
+            client._record('set', key, cmds[key][1], start, self.host)